@@ -14,9 +14,17 @@ The CloudFront Host header is preserved for OAuth callback URL validation.
 IMPORTANT: This addon also replicates production security headers (CSP, X-Frame-Options, etc.)
 on responses from the local server to ensure dev/prod parity and catch CSP violations early.
 
+Response bodies larger than ndx_stream_threshold (default 1k, by Content-Length) are
+streamed rather than buffered, as the addon only rewrites response headers. Streamed
+bodies are not stored, so mitmproxy shows them as "(content missing)". Request bodies
+are always buffered so that request() can reroute them before mitmproxy connects upstream.
+
 Usage:
     mitmproxy --scripts scripts/mitmproxy-addon.py --listen-port 8081
 
+    Add --set ndx_log_level=INFO to log each routing decision.
+    Add --set ndx_stream_threshold (no value) to buffer every response for inspection.
+
 Requirements:
     - Python 3.8+
     - mitmproxy 10.x+
@@ -30,20 +38,31 @@ Architecture:
 For more information, see: /docs/development/local-try-setup.md
 """
 
-from mitmproxy import http
+from mitmproxy import ctx, exceptions, http
+from mitmproxy.utils import human
+from typing import Optional
+import functools
 import logging
 
-# Configure logging for routing decisions
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Logger for routing decisions; output goes through mitmproxy's own log handlers.
+# Its level is set by the ndx_log_level option (see LocalForward.configure)
+logger = logging.getLogger("ndx.addon")
 
 # Configuration constants
 CLOUDFRONT_DOMAIN = "ndx.digital.cabinet-office.gov.uk"
 LOCAL_SERVER_HOST = "localhost"
 LOCAL_SERVER_PORT = 8080
 
+# Default ndx_stream_threshold: responses with a Content-Length above this are
+# streamed to the browser instead of buffered. Only responses: the global
+# stream_large_bodies option would also stream request bodies, which mitmproxy
+# sends upstream before request() has a chance to reroute them to the local server
+DEFAULT_STREAM_THRESHOLD = "1k"
+
+# Per-request routing messages are logged at INFO, so they are hidden by default
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+DEFAULT_LOG_LEVEL = "WARNING"
+
 # Production security headers from CloudFront
 # These MUST match production to catch CSP violations during local development
 SECURITY_HEADERS = {
@@ -67,117 +86,262 @@ SECURITY_HEADERS = {
     # "strict-transport-security": "max-age=46656000; includeSubDomains",
 }
 
+# SECURITY_HEADERS as raw (name, value) byte pairs, so responseheaders() can rewrite
+# mitmproxy's header fields in one pass instead of once per header
+SECURITY_HEADER_FIELDS = tuple(
+    (name.encode(), value.encode()) for name, value in SECURITY_HEADERS.items()
+)
+_SECURITY_HEADER_NAMES = frozenset(name for name, _ in SECURITY_HEADER_FIELDS)
+
 # UI routes that should be forwarded to local development server
-UI_ROUTES = [
+# Each entry is a path prefix; a tuple lets str.startswith test them all in C
+UI_ROUTES = (
     "/",                # Homepage
     "/catalogue",       # Product catalogue pages (exact match)
     "/catalogue/",      # Product catalogue pages (with trailing slash or subpaths)
     "/try",             # Try sessions dashboard
     "/assets/",         # Static assets (CSS, JS, images)
-]
-
-
-def request(flow: http.HTTPFlow) -> None:
-    """
-    Intercept and conditionally route HTTP requests based on destination and path.
-
-    This function is called by mitmproxy for each HTTP request before it is forwarded
-    to the upstream server. It modifies the request destination for UI routes while
-    preserving API routes unchanged.
-
-    Args:
-        flow: mitmproxy HTTPFlow object containing request/response data
-
-    Routing Logic:
-        1. Check if request is to CloudFront domain (ndx.digital.cabinet-office.gov.uk)
-        2. If CloudFront domain:
-           a. If path starts with /api/ or /signup-api/ → Pass through unchanged (APIs)
-           b. Else if path matches UI routes → Forward to localhost:8080 (UI)
-           c. Else → Pass through unchanged (OAuth callbacks, etc.)
-        3. If not CloudFront domain → Ignore (pass through unchanged)
-
-    Returns:
-        None (modifies flow.request in-place)
-    """
-    # Only process requests to CloudFront domain (ignore all other domains)
-    if flow.request.pretty_host != CLOUDFRONT_DOMAIN:
-        return  # Pass through unchanged (not targeting CloudFront domain)
+)
 
-    request_path = flow.request.path
+# API routes that must always reach CloudFront (checked before UI routes)
+API_ROUTES = (
+    "/api/",            # Innovation Sandbox APIs
+    "/signup-api/",     # Signup Lambda APIs
+)
 
-    # API routes pass through to CloudFront unchanged (preserve auth headers, OAuth, etc.)
-    if request_path.startswith("/api/") or request_path.startswith("/signup-api/"):
-        logging.info(f"API Route: {request_path} → CloudFront (passthrough)")
-        return  # No modification - API requests go to CloudFront backend
+# Routing decisions returned by match()
+ROUTE_API = "api"
+ROUTE_UI = "ui"
+ROUTE_PASSTHROUGH = "passthrough"
 
-    # Check if request path matches any UI route patterns
-    is_ui_route = False
-    for ui_pattern in UI_ROUTES:
-        if ui_pattern == request_path or request_path.startswith(ui_pattern):
-            is_ui_route = True
-            break
+# Two-character heads of the API routes ("/a", "/s"); only paths starting with
+# one of these can be an API route
+_API_ROUTE_HEADS = frozenset(route[:2] for route in API_ROUTES)
 
-    # UI routes forward to localhost:8080 (local NDX development server)
-    if is_ui_route:
-        # Preserve original Host header for OAuth callback URL validation
-        # This ensures OAuth redirects work correctly (Innovation Sandbox expects CloudFront domain)
-        original_host = flow.request.headers.get("Host", CLOUDFRONT_DOMAIN)
+# Bound once so the matchers skip the attribute lookup on every request
+_startswith = str.startswith
 
-        # Modify request to route to local server
-        flow.request.scheme = "http"  # Local server uses HTTP (not HTTPS)
-        flow.request.host = LOCAL_SERVER_HOST
-        flow.request.port = LOCAL_SERVER_PORT
 
-        # Restore CloudFront Host header (critical for OAuth validation)
-        flow.request.headers["Host"] = original_host
+def _match_ui(path: str) -> str:
+    """Return ROUTE_UI if path starts with a UI route, else ROUTE_PASSTHROUGH."""
+    if _startswith(path, UI_ROUTES):
+        return ROUTE_UI
+    return ROUTE_PASSTHROUGH
 
-        # Mark this flow as locally routed so response() can add security headers
-        flow.metadata["locally_routed"] = True
 
-        logging.info(f"UI Route: {request_path} → {LOCAL_SERVER_HOST}:{LOCAL_SERVER_PORT} (Host header preserved: {original_host})")
-    else:
-        # Non-UI, non-API routes pass through to CloudFront unchanged
-        # Examples: OAuth callbacks (/callback), other static pages
-        logging.info(f"Passthrough: {request_path} → CloudFront (unchanged)")
+@functools.lru_cache(maxsize=4096)
+def _match_api_head(path: str) -> str:
+    """Classify a path whose head matches an API route; memoised, called by match()."""
+    if _startswith(path, API_ROUTES):
+        return ROUTE_API
+    return _match_ui(path)
 
 
-def response(flow: http.HTTPFlow) -> None:
+def match(path: str) -> str:
     """
-    Inject production security headers on responses from locally-routed requests.
+    Classify a request path as an API, UI or passthrough route.
 
-    This ensures that local development mirrors production CSP behavior,
-    allowing developers to catch CSP violations before deploying to production.
+    API routes are checked first so they win over the "/" UI route, which
+    (like every UI route) is matched as a prefix. A two-character head check
+    sends every other path straight to the UI prefix test. Only paths sharing a
+    head with an API route (e.g. /api/..., /assets/..., /signup/...) are
+    memoised, so one-off URLs elsewhere such as /?token=... never enter the cache.
 
     Args:
-        flow: mitmproxy HTTPFlow object containing request/response data
+        path: Request path (including any query string)
 
-    Security Headers Added:
-        - Content-Security-Policy: Restricts resource loading to 'self'
-        - X-Frame-Options: DENY - Prevents clickjacking
-        - X-Content-Type-Options: nosniff - Prevents MIME sniffing
-        - Referrer-Policy: no-referrer - Prevents referrer leakage
+    Returns:
+        ROUTE_API, ROUTE_UI or ROUTE_PASSTHROUGH
+    """
+    if path[:2] in _API_ROUTE_HEADS:
+        return _match_api_head(path)
+    return _match_ui(path)
 
-    Note:
-        HSTS header is omitted for local dev as we use HTTP to localhost.
-        In production, CloudFront adds HSTS via response headers policy.
 
-    Returns:
-        None (modifies flow.response in-place)
+class LocalForward:
     """
-    # Only add security headers to responses from locally-routed requests
-    if not flow.metadata.get("locally_routed"):
-        return
+    mitmproxy addon that routes CloudFront UI requests to the local NDX server.
 
-    # Add production security headers to match CloudFront configuration
-    for header_name, header_value in SECURITY_HEADERS.items():
-        flow.response.headers[header_name] = header_value
+    The hooks run directly on mitmproxy's event loop. They do no blocking I/O and
+    only take microseconds, so handing them to a worker thread (@concurrent)
+    would cost more than it could save.
+    """
 
-    logging.debug(f"Added security headers to response: {flow.request.path}")
+    def __init__(self) -> None:
+        # Parsed ndx_stream_threshold in bytes (None disables streaming)
+        self.stream_threshold: Optional[int] = None
+
+    def load(self, loader) -> None:
+        """
+        Register addon options.
+
+        Args:
+            loader: mitmproxy AddonLoader used to register the ndx_* options
+        """
+        loader.add_option(
+            name="ndx_log_level",
+            typespec=str,
+            default=DEFAULT_LOG_LEVEL,
+            help="Log level for NDX routing decisions (INFO logs every routed request)",
+            choices=LOG_LEVELS,
+        )
+        loader.add_option(
+            name="ndx_stream_threshold",
+            typespec=Optional[str],
+            default=DEFAULT_STREAM_THRESHOLD,
+            help=(
+                "Stream responses whose Content-Length exceeds this size instead of "
+                "buffering them. Streamed bodies are not kept, so they cannot be "
+                "inspected in mitmproxy. Understands k/m/g suffixes; "
+                "set with no value to disable streaming."
+            ),
+        )
+
+    def configure(self, updated: set) -> None:
+        """
+        Apply the ndx_log_level and ndx_stream_threshold options.
+
+        Args:
+            updated: Names of the options that changed
+
+        Raises:
+            OptionsError: If ndx_stream_threshold is not a valid size
+        """
+        if "ndx_log_level" in updated:
+            logger.setLevel(ctx.options.ndx_log_level)
+
+        if "ndx_stream_threshold" in updated:
+            try:
+                self.stream_threshold = human.parse_size(ctx.options.ndx_stream_threshold)
+            except ValueError:
+                raise exceptions.OptionsError(
+                    f"Invalid ndx_stream_threshold specification: "
+                    f"{ctx.options.ndx_stream_threshold}"
+                )
+
+    def request(self, flow: http.HTTPFlow) -> None:
+        """
+        Intercept and conditionally route HTTP requests based on destination and path.
+
+        This function is called by mitmproxy for each HTTP request before it is forwarded
+        to the upstream server. It modifies the request destination for UI routes while
+        preserving API routes unchanged.
+
+        Args:
+            flow: mitmproxy HTTPFlow object containing request/response data
+
+        Routing Logic:
+            1. Check if request is to CloudFront domain (ndx.digital.cabinet-office.gov.uk)
+            2. If CloudFront domain:
+               a. If path starts with /api/ or /signup-api/ → Pass through unchanged (APIs)
+               b. Else if path matches UI routes → Forward to localhost:8080 (UI)
+               c. Else → Pass through unchanged (OAuth callbacks, etc.)
+            3. If not CloudFront domain → Ignore (pass through unchanged)
+
+        Returns:
+            None (modifies flow.request in-place)
+        """
+        req = flow.request
+
+        # Only process requests to CloudFront domain (ignore all other domains)
+        # Check the raw Host header first; only parse it via pretty_host when it
+        # could still be the CloudFront domain (e.g. with a port) or is missing
+        host = req.host_header
+        if host != CLOUDFRONT_DOMAIN:
+            if host and not host.startswith(CLOUDFRONT_DOMAIN):
+                return  # Pass through unchanged (not targeting CloudFront domain)
+            if req.pretty_host != CLOUDFRONT_DOMAIN:
+                return  # Pass through unchanged (not targeting CloudFront domain)
+
+        request_path = req.path
+        route = match(request_path)
+
+        # API routes pass through to CloudFront unchanged (preserve auth headers, OAuth, etc.)
+        if route == ROUTE_API:
+            logger.info("API Route: %s → CloudFront (passthrough)", request_path)
+            return  # No modification - API requests go to CloudFront backend
+
+        # UI routes forward to localhost:8080 (local NDX development server)
+        if route == ROUTE_UI:
+            # Modify request to route to local server
+            req.scheme = "http"  # Local server uses HTTP (not HTTPS)
+            req.host = LOCAL_SERVER_HOST
+            req.port = LOCAL_SERVER_PORT
+
+            # Restore CloudFront Host header (critical for OAuth validation)
+            # This ensures OAuth redirects work correctly (Innovation Sandbox expects CloudFront domain).
+            # The host check above means the original Host was the CloudFront domain,
+            # so it is set directly rather than read back before the rewrite
+            req.headers["Host"] = CLOUDFRONT_DOMAIN
+
+            # Mark this request as locally routed so responseheaders() can add security headers
+            # (a plain attribute avoids populating flow.metadata on every routed flow)
+            req.is_locally_routed = True
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "UI Route: %s → %s:%s (Host header preserved: %s)",
+                    request_path, LOCAL_SERVER_HOST, LOCAL_SERVER_PORT, CLOUDFRONT_DOMAIN,
+                )
+        else:
+            # Non-UI, non-API routes pass through to CloudFront unchanged
+            # Examples: OAuth callbacks (/callback), other static pages
+            logger.info("Passthrough: %s → CloudFront (unchanged)", request_path)
+
+    def responseheaders(self, flow: http.HTTPFlow) -> None:
+        """
+        Stream large responses and inject production security headers on responses
+        from locally-routed requests.
+
+        This ensures that local development mirrors production CSP behavior,
+        allowing developers to catch CSP violations before deploying to production.
+
+        Runs as soon as the response headers arrive, before the body is read. The
+        addon never reads response bodies, so large assets (JS bundles, images) are
+        streamed instead of buffered in Python, and the security headers still apply
+        because they are set before streaming starts.
+
+        Args:
+            flow: mitmproxy HTTPFlow object containing request/response data
+
+        Security Headers Added:
+            - Content-Security-Policy: Restricts resource loading to 'self'
+            - X-Frame-Options: DENY - Prevents clickjacking
+            - X-Content-Type-Options: nosniff - Prevents MIME sniffing
+            - Referrer-Policy: no-referrer - Prevents referrer leakage
+
+        Note:
+            HSTS header is omitted for local dev as we use HTTP to localhost.
+            In production, CloudFront adds HSTS via response headers policy.
+
+        Returns:
+            None (modifies flow.response in-place)
+        """
+        response = flow.response
+
+        # Stream bodies above ndx_stream_threshold; responses without a
+        # Content-Length (e.g. chunked) are left to mitmproxy's defaults
+        threshold = self.stream_threshold
+        if threshold is not None and not response.stream:
+            content_length = response.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > threshold:
+                response.stream = True
+
+        # Only add security headers to responses from locally-routed requests
+        if not getattr(flow.request, "is_locally_routed", False):
+            return
+
+        # Add production security headers to match CloudFront configuration,
+        # replacing any values the local server already set for them
+        headers = response.headers
+        headers.fields = tuple(
+            field for field in headers.fields
+            if field[0].lower() not in _SECURITY_HEADER_NAMES
+        ) + SECURITY_HEADER_FIELDS
+
+        logger.debug("Added security headers to response: %s", flow.request.path)
 
 
 # mitmproxy addon registration
 # This list is required for mitmproxy to discover and load the addon
-addons = [
-    # No class-based addon needed for this simple request() function
-    # mitmproxy automatically discovers module-level request() function
-]
+addons = [LocalForward()]